@@ -1,4 +1,8 @@
 import os
+import json
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 from typing import List, Tuple, Dict, Optional
@@ -9,32 +13,96 @@ class CharVocab:
         self.stoi = {ch: i for i, ch in enumerate(chars)}
         self.itos = {i: ch for i, ch in enumerate(chars)}
         self.vocab_size = len(chars)
+        self._build_lut()
+
+    def _build_lut(self):
+        # codepoint -> id table; the extra last slot is -1 and catches anything out of range
+        max_cp = max((ord(c) for c in self.stoi), default=-1)
+        self.lut = np.full(max_cp + 2, -1, dtype=np.int32)
+        for c, i in self.stoi.items():
+            self.lut[ord(c)] = i
+
+    def encode_array(self, s: str) -> np.ndarray:
+        cps = np.frombuffer(s.encode("utf-32-le"), dtype=np.uint32)
+        ids = self.lut[np.minimum(cps, len(self.lut) - 1)]
+        return ids[ids >= 0] # silently ignore unknown chars for now or could error
 
     def encode(self, s: str) -> List[int]:
-        return [self.stoi[c] for c in s if c in self.stoi] # silently ignore unknown chars for now or could error
+        return self.encode_array(s).tolist()
 
     def decode(self, ids: List[int]) -> str:
         return "".join([self.itos[i] for i in ids if i in self.itos])
 
+    def load_state_dict(self, stoi: Dict[str, int], itos: Dict[int, str]):
+        self.stoi = stoi
+        self.itos = itos
+        self.vocab_size = len(stoi)
+        self._build_lut()
+
     def __len__(self) -> int:
         return self.vocab_size
 
-class CharLMIndexedDataset(Dataset):
-    def __init__(self, tokens: torch.Tensor, block_size: int, packed: bool = False):
-        self.tokens = tokens
+class TokenWindowDataset(Dataset):
+    """
+    Next-token (x, y) windows of block_size over a flat token array. Shuffled
+    sampling gives random windows; packed uses block_size strides.
+    Subclasses provide `array` (a NumPy view of the tokens) and name the attribute
+    caching it in `_lazy_attr`; that cache is dropped when pickled to a DataLoader
+    worker and rebuilt on first use there.
+    """
+    _lazy_attr: str
+
+    def __init__(self, num_tokens: int, block_size: int, packed: bool = False):
         self.block_size = block_size
         self.packed = packed
-        
+        self.offsets = np.arange(block_size)
+        setattr(self, self._lazy_attr, None)
+
         if packed:
             # Drop last tokens to make it divisible by block_size+1 if needed, 
             # or just ensure we can take chunks of block_size+1
-            self.num_chunks = (len(tokens) - 1) // block_size
+            self.num_chunks = (num_tokens - 1) // block_size
         else:
-            self.num_chunks = len(tokens) - block_size
+            self.num_chunks = num_tokens - block_size
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state[self._lazy_attr] = None
+        return state
+
+    @property
+    def array(self) -> np.ndarray:
+        raise NotImplementedError
 
     def __len__(self) -> int:
         return self.num_chunks
 
+    def __getitems__(self, indices: List[int]) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Batched fast path used by DataLoader: one gather per batch instead of one
+        # __getitem__ per sample. Returns an already-collated (B, block_size) pair,
+        # so pair it with collate_fn=collate_prebatched.
+        starts = np.asarray(indices) * (self.block_size if self.packed else 1)
+        idx = starts[:, None] + self.offsets
+        data = self.array
+        x = torch.from_numpy(data[idx].astype(np.int64, copy=False))
+        y = torch.from_numpy(data[idx + 1].astype(np.int64, copy=False))
+        return x, y
+
+class CharLMIndexedDataset(TokenWindowDataset):
+    # DataLoader workers receive the tensor through shared memory but would get the
+    # ndarray pickled by value, i.e. a full copy of the corpus per worker
+    _lazy_attr = "_tokens_np"
+
+    def __init__(self, tokens: torch.Tensor, block_size: int, packed: bool = False):
+        self.tokens = tokens
+        super().__init__(len(tokens), block_size, packed)
+
+    @property
+    def array(self) -> np.ndarray:
+        if self._tokens_np is None:
+            self._tokens_np = self.tokens.numpy() # shares memory (and the mmap, if any) with tokens
+        return self._tokens_np
+
     def __getitem__(self, idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
         if self.packed:
             start = idx * self.block_size
@@ -46,15 +114,103 @@ class CharLMIndexedDataset(Dataset):
         y = chunk[1:]
         return x, y
 
+class MemmapLMDataset(TokenWindowDataset):
+    """
+    Windows over a flat uint16 token file written by scripts/prepare_data.py.
+    The memmap is opened lazily in whichever process first reads it (i.e. each
+    DataLoader worker), never pickled, so startup cost is independent of corpus size.
+    """
+    _lazy_attr = "_data"
+
+    def __init__(self, path: str, block_size: int, packed: bool = False):
+        self.path = path
+        self.num_tokens = os.path.getsize(path) // np.dtype(np.uint16).itemsize
+        super().__init__(self.num_tokens, block_size, packed)
+
+    @property
+    def array(self) -> np.memmap:
+        if self._data is None:
+            self._data = np.memmap(self.path, dtype=np.uint16, mode="r", shape=(self.num_tokens,))
+        return self._data
+
+    def __getitem__(self, idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        start = idx * self.block_size if self.packed else idx
+        chunk = self.array[start : start + self.block_size + 1].astype(np.int64)
+        return torch.from_numpy(chunk[:-1]), torch.from_numpy(chunk[1:])
+
+def collate_prebatched(batch):
+    return batch
+
 from .tokenizer import BPETokenizer
 
+_worker_tokenizer = None
+
+def _init_encode_worker(merges: Dict[Tuple[int, int], int]):
+    # Runs once per pool worker so the merges table is not re-sent with every chunk
+    global _worker_tokenizer
+    _worker_tokenizer = BPETokenizer()
+    _worker_tokenizer.load_state_dict(merges)
+
+def _encode_chunk(chunk: str) -> List[int]:
+    return _worker_tokenizer.encode(chunk)
+
+def _split_at_newlines(text: str, chunk_size: int) -> List[str]:
+    """Splits text into ~chunk_size pieces that end on a newline where possible, so
+    chunk boundaries fall between lines rather than inside words."""
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        if end < len(text):
+            nl = text.rfind("\n", start, end)
+            if nl != -1:
+                end = nl + 1
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+def save_tokens_bin(path: str, tokens: torch.Tensor):
+    """
+    Writes tokens as a flat binary (path + ".bin") plus a small index
+    (path + ".idx.json") with dtype and shape, so it can be memory-mapped back.
+    The index is written last and marks the cache as complete.
+    """
+    arr = tokens.numpy()
+    with open(path + ".bin", "wb") as f:
+        arr.tofile(f)
+    with open(path + ".idx.json", "w", encoding="utf-8") as f:
+        json.dump({"dtype": str(arr.dtype), "shape": list(arr.shape)}, f)
+
+def load_tokens_bin(path: str) -> torch.Tensor:
+    """Memory-maps a cache written by save_tokens_bin; pages are read on demand."""
+    with open(path + ".idx.json", "r", encoding="utf-8") as f:
+        index = json.load(f)
+    # copy-on-write so torch gets a writable array while the file stays untouched
+    arr = np.memmap(path + ".bin", dtype=index["dtype"], mode="c", shape=tuple(index["shape"]))
+    return torch.from_numpy(arr)
+
+def load_prepared_vocab(data_dir: str):
+    """Rebuilds the vocab recorded in data_dir/meta.json by scripts/prepare_data.py.
+    Returns (vocab, tokenizer_type)."""
+    with open(os.path.join(data_dir, "meta.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+
+    if meta["tokenizer"] == "bpe":
+        vocab = BPETokenizer()
+        vocab.load(os.path.join(data_dir, "tokenizer"))
+    else:
+        vocab = CharVocab("")
+        chars = meta["chars"]
+        vocab.load_state_dict({ch: i for i, ch in enumerate(chars)}, {i: ch for i, ch in enumerate(chars)})
+    return vocab, meta["tokenizer"]
+
 def load_corpus_and_vocab(path: str, block_size: int, tokenizer_type: str = "char", vocab_size: int = 2048):
     with open(path, 'r', encoding='utf-8') as f:
         text = f.read()
     
     if tokenizer_type == "bpe":
         tokenizer_path = path + ".bpe"
-        tokens_cache_path = path + ".bpe.tokens.pt"
+        tokens_cache_path = path + ".bpe.tokens"
         tokenizer = BPETokenizer()
         
         # Try to load existing tokenizer
@@ -70,30 +226,33 @@ def load_corpus_and_vocab(path: str, block_size: int, tokenizer_type: str = "cha
         vocab = tokenizer
         
         # Try to load cached tokens
-        if os.path.exists(tokens_cache_path):
-            print(f"Loading cached tokens from {tokens_cache_path}...")
-            tokens = torch.load(tokens_cache_path)
+        if os.path.exists(tokens_cache_path + ".idx.json"):
+            print(f"Loading cached tokens from {tokens_cache_path}.bin...")
+            tokens = load_tokens_bin(tokens_cache_path)
             print(f"Loaded {len(tokens)} tokens from cache")
         else:
             print(f"Encoding corpus (this may take a while for large files)...")
-            # Encode in chunks with progress
-            chunk_size = 100000  # characters per chunk
+            # Encode line-aligned chunks in parallel with progress
+            chunks = _split_at_newlines(text, 100000)  # ~characters per chunk
             all_ids = []
-            for i in range(0, len(text), chunk_size):
-                chunk = text[i:i+chunk_size]
-                ids = tokenizer.encode(chunk)
-                all_ids.extend(ids)
-                if (i // chunk_size) % 10 == 0:
-                    print(f"  Encoded {i + len(chunk):,} / {len(text):,} chars...")
+            encoded_chars = 0
+            # fork (where available) shares the merges table copy-on-write with workers
+            mp_context = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else None
+            with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=mp_context,
+                                     initializer=_init_encode_worker, initargs=(tokenizer.merges,)) as pool:
+                for i, (chunk, ids) in enumerate(zip(chunks, pool.map(_encode_chunk, chunks, chunksize=4))):
+                    all_ids.extend(ids)
+                    encoded_chars += len(chunk)
+                    if i % 10 == 0:
+                        print(f"  Encoded {encoded_chars:,} / {len(text):,} chars...")
             print(f"Encoding complete: {len(all_ids):,} tokens")
             tokens = torch.tensor(all_ids, dtype=torch.long)
-            torch.save(tokens, tokens_cache_path)
-            print(f"Saved tokens cache to {tokens_cache_path}")
+            save_tokens_bin(tokens_cache_path, tokens)
+            print(f"Saved tokens cache to {tokens_cache_path}.bin")
     else:
         # Char level fallback
         vocab = CharVocab(text)
-        ids = vocab.encode(text)
-        tokens = torch.tensor(ids, dtype=torch.long)
+        tokens = torch.from_numpy(vocab.encode_array(text).astype(np.int64))
     
     return vocab, tokens
 
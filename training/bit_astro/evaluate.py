@@ -13,25 +13,34 @@ def set_seed(seed: int):
     if torch.cuda.is_available():
         torch.cuda.manual_seed_all(seed)
 
-def nucleus_sampling(logits, top_p=0.9, temperature=1.0):
-    logits = logits / max(temperature, 1e-6)
-    probs = F.softmax(logits, dim=-1)
-    
+def nucleus_sampling(logits, top_p=0.9, temperature=1.0, top_k=None):
+    """
+    Sample next token ids (B, 1) from the smallest set of tokens whose probability
+    mass reaches top_p. Only the top-k head is sorted (torch.topk) instead of the
+    full vocab; without an explicit top_k the head is 1024 tokens and its
+    probabilities are still normalized against the full vocab.
+    """
+    temperature = max(temperature, 1e-6)
+    if top_p >= 1.0 and top_k is None:
+        probs = F.softmax(logits / temperature, dim=-1)
+        return torch.multinomial(probs, num_samples=1)
+
+    k = min(top_k if top_k else 1024, logits.size(-1))
+    topv, topi = torch.topk(logits, k, dim=-1) # sorted descending
+    topv = topv / temperature
+    if top_k:
+        probs = F.softmax(topv, dim=-1)
+    else:
+        probs = torch.exp(topv - torch.logsumexp(logits / temperature, dim=-1, keepdim=True))
+
     if top_p < 1.0:
-        sorted_probs, sorted_idx = torch.sort(probs, descending=True)
-        cdf = torch.cumsum(sorted_probs, dim=-1)
-        
-        # Remove tokens with cumulative probability above the threshold
-        sorted_indices_to_remove = cdf > top_p
-        # Shift the indices to the right to keep also the first token above the threshold
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-        
-        indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_idx, sorted_indices_to_remove)
-        probs = probs.masked_fill(indices_to_remove, 0.0)
-        probs = probs / probs.sum(dim=-1, keepdim=True)
-        
-    return probs
+        cdf = torch.cumsum(probs, dim=-1)
+        # Keep every token whose preceding mass is within top_p, so the first token
+        # above the threshold (and always the most likely one) survives
+        probs = probs.masked_fill(cdf - probs > top_p, 0.0)
+
+    sample = torch.multinomial(probs, num_samples=1) # multinomial does not need normalized probs
+    return topi.gather(-1, sample)
 
 def main():
     parser = argparse.ArgumentParser(description="Sample from BitAstroGPT")
@@ -43,8 +52,12 @@ def main():
     parser.add_argument("--top-k", type=int, default=None, help="Top-k sampling (optional)")
     parser.add_argument("--seed", type=int, default=1337, help="Random seed for deterministic sampling")
     parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="Device to use")
+    # Off by default: a one-shot sample is faster through the eager KV cache than through
+    # compile warm-up plus a full block_size forward per token
+    parser.add_argument("--compile", type=str, default="false", help="torch.compile the model on CUDA (true/false)")
 
     args = parser.parse_args()
+    args.compile = args.compile.lower() == "true"
     
     set_seed(args.seed)
 
@@ -72,9 +85,7 @@ def main():
              raise ValueError("Checkpoint is BPE but missing 'vocab_merges'.")
     elif 'vocab_stoi' in checkpoint and 'vocab_itos' in checkpoint:
         vocab = CharVocab("") # Dummy init
-        vocab.stoi = checkpoint['vocab_stoi']
-        vocab.itos = checkpoint['vocab_itos']
-        vocab.vocab_size = len(vocab.stoi)
+        vocab.load_state_dict(checkpoint['vocab_stoi'], checkpoint['vocab_itos'])
     else:
         raise ValueError("Checkpoint does not contain vocab info. Cannot decode.")
 
@@ -83,6 +94,11 @@ def main():
     model.load_state_dict(checkpoint['model_state_dict'])
     model.to(args.device)
     model.eval()
+
+    use_compile = args.compile and hasattr(torch, "compile") and args.device.startswith("cuda")
+    if use_compile:
+        print("Compiling model (the first generated token includes compile time)...")
+        model = torch.compile(model, mode="reduce-overhead", dynamic=False)
     
     # Report metrics if available
     if 'val_loss' in checkpoint:
@@ -103,15 +119,24 @@ def main():
     
     # Custom generation loop for top-p
     y = x
-    with torch.no_grad():
+    past_kv = None
+    with torch.inference_mode():
         for _ in range(args.max_new_tokens):
-            idx_cond = y[:, -config.block_size:]
-            logits, _ = model(idx_cond)
-            logits = logits[:, -1, :]
-            
-            probs = nucleus_sampling(logits, top_p=args.top_p, temperature=args.temperature)
+            if use_compile:
+                # Right-pad to block_size so every step has the same shape and replays one
+                # CUDA graph; causal attention keeps the padding out of real positions.
+                # (The growing KV cache would recompile on every length.)
+                idx_cond = y[:, -config.block_size:]
+                T = idx_cond.size(1)
+                logits, _ = model(F.pad(idx_cond, (0, config.block_size - T)))
+                logits = logits[:, T - 1, :]
+            else:
+                # Prefill once, then only the newest token goes through the KV cache
+                idx_cond = y[:, -config.block_size:] if past_kv is None else y[:, -1:]
+                logits, _, past_kv = model(idx_cond, past_kv=past_kv, use_cache=True)
+                logits = logits[:, -1, :]
             
-            next_token = torch.multinomial(probs, num_samples=1)
+            next_token = nucleus_sampling(logits, top_p=args.top_p, temperature=args.temperature, top_k=args.top_k)
             y = torch.cat([y, next_token], dim=1)
     
     output_text = vocab.decode(y[0].tolist())
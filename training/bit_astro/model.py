@@ -4,13 +4,16 @@ from __future__ import annotations
 
 import math
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from .ternary import TernaryLinear
+from .rope_fused import HAS_TRITON as HAS_FUSED_ROPE, fused_rotary_pos_emb
+from .swiglu_fused import HAS_TRITON as HAS_FUSED_SWIGLU, swiglu_fused
 
 # -----------------------------
 # Config
@@ -80,30 +83,29 @@ class RotaryEmbedding(nn.Module):
         inv_freq = 1.0 / (10000 ** (torch.arange(0, dim, 2).float() / dim))
         self.register_buffer("inv_freq", inv_freq)
         self.max_seq_len = max_seq_len
-        self.cached_cos = None
-        self.cached_sin = None
+        # Precompute cos/sin for every position up front; not persistent so it stays out of checkpoints
+        t = torch.arange(max_seq_len, dtype=inv_freq.dtype)
+        freqs = torch.einsum("i,j->ij", t, inv_freq)
+        emb = torch.cat((freqs, freqs), dim=-1)
+        self.register_buffer("cached_cos", emb.cos()[None, :, :], persistent=False)
+        self.register_buffer("cached_sin", emb.sin()[None, :, :], persistent=False)
 
     def forward(self, x, seq_len=None):
         # x: [batch, seq_len, head_dim]
         if seq_len is None:
             seq_len = x.shape[1]
-            
-        if self.cached_cos is None or self.cached_cos.shape[0] < seq_len:
-            t = torch.arange(seq_len, device=x.device, dtype=self.inv_freq.dtype)
-            freqs = torch.einsum("i,j->ij", t, self.inv_freq)
-            emb = torch.cat((freqs, freqs), dim=-1)
-            self.cached_cos = emb.cos()[None, :, :]
-            self.cached_sin = emb.sin()[None, :, :]
-            
         return self.cached_cos[:, :seq_len, :], self.cached_sin[:, :seq_len, :]
 
 def rotate_half(x):
     x1, x2 = x[..., :x.shape[-1]//2], x[..., x.shape[-1]//2:]
     return torch.cat((-x2, x1), dim=-1)
 
+def apply_rotary(x, cos, sin):
+    return (x * cos) + (rotate_half(x) * sin)
+
 def apply_rotary_pos_emb(q, k, cos, sin):
     # q, k: [batch, seq_len, head_dim]
-    return (q * cos) + (rotate_half(q) * sin), (k * cos) + (rotate_half(k) * sin)
+    return apply_rotary(q, cos, sin), apply_rotary(k, cos, sin)
 
 
 # -----------------------------
@@ -124,6 +126,11 @@ class RMSNorm(nn.Module):
         return output * self.weight
 
 
+def make_dropout(p: float) -> nn.Module:
+    # Skip the module dispatch entirely when dropout is disabled (e.g. small_config)
+    return nn.Dropout(p) if p > 0.0 else nn.Identity()
+
+
 # -----------------------------
 # Binary Linear layer (Legacy / Fallback)
 # -----------------------------
@@ -170,59 +177,95 @@ class BinarySelfAttention(nn.Module):
         self.head_dim = config.d_model // config.n_heads
         self.dropout = config.dropout
 
-        self.dropout = config.dropout
-
         # Projections
         Linear = TernaryLinear if config.use_ternary else nn.Linear
         # Note: Original code used BinaryLinear, but we are moving to Ternary or standard Linear
         # If use_ternary is False, we default to nn.Linear for stability unless BinaryLinear is explicitly desired.
         # For now, let's assume use_ternary=True means TernaryLinear, else nn.Linear (float).
         
-        self.q_proj = Linear(config.d_model, config.d_model, bias=False)
-        self.k_proj = Linear(config.d_model, config.d_model, bias=False)
-        self.v_proj = Linear(config.d_model, config.d_model, bias=False)
+        # q, k and v share one projection: a single matmul over x, rows ordered [q; k; v]
+        self.qkv = Linear(config.d_model, 3 * config.d_model, bias=False)
         self.o_proj = Linear(config.d_model, config.d_model, bias=False)
 
-        self.attn_drop = nn.Dropout(config.dropout)
-        self.resid_drop = nn.Dropout(config.dropout)
+        self.resid_drop = make_dropout(config.dropout)
         
-        self.rotary = RotaryEmbedding(self.head_dim)
+        self.block_size = config.block_size
+        self.rotary = RotaryEmbedding(self.head_dim, max_seq_len=config.block_size)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints from before the fused projection have separate q/k/v_proj layers.
+        # Every tensor in them (weight, per-row ternary threshold) is per output row,
+        # so stacking them along dim 0 reproduces the fused layer exactly.
+        old = prefix + "q_proj."
+        for key in [k for k in state_dict if k.startswith(old)]:
+            suffix = key[len(old):]
+            parts = [state_dict.pop(f"{prefix}{name}.{suffix}") for name in ("q_proj", "k_proj", "v_proj")]
+            state_dict[f"{prefix}qkv.{suffix}"] = torch.cat(parts, dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(
         self,
         x: torch.Tensor,
-        mask: Optional[torch.Tensor] = None,
-    ) -> torch.Tensor:
+        past_kv: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    ) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Returns (y, (k, v)) where k, v: (B, nh, L, hs) are this layer's keys (before
+        RoPE) and values for the whole window, to be fed back as past_kv.
+        """
         B, T, C = x.size()
 
         # q, k, v projections
-        q = self.q_proj(x).view(B, T, self.n_heads, self.head_dim).transpose(1, 2) # (B, nh, T, hs)
-        k = self.k_proj(x).view(B, T, self.n_heads, self.head_dim).transpose(1, 2) # (B, nh, T, hs)
-        v = self.v_proj(x).view(B, T, self.n_heads, self.head_dim).transpose(1, 2) # (B, nh, T, hs)
-
-        # Apply RoPE
-        cos, sin = self.rotary(v, seq_len=T) # cos, sin: (1, T, hs)
-        
-        # Adjust dims for broadcasting: (1, 1, T, hs)
-        cos = cos.unsqueeze(1)
-        sin = sin.unsqueeze(1)
-        
-        q, k = apply_rotary_pos_emb(q, k, cos, sin)
-
-        # Scaled dot-product attention
-        att = (q @ k.transpose(-2, -1)) / math.sqrt(self.head_dim)  # (B, n_heads, T, T)
+        q, k, v = self.qkv(x).view(B, T, 3, self.n_heads, self.head_dim).unbind(dim=2)
+        q = q.transpose(1, 2) # (B, nh, T, hs)
+        k = k.transpose(1, 2) # (B, nh, T, hs)
+        v = v.transpose(1, 2) # (B, nh, T, hs)
 
-        if mask is not None:
-            att = att.masked_fill(mask == 0, float("-inf"))
+        if past_kv is None:
+            present = (k, v)
 
-        att = F.softmax(att, dim=-1)
-        att = self.attn_drop(att)
-
-        y = att @ v  # (B, n_heads, T, head_dim)
+            # Apply RoPE
+            cos, sin = self.rotary(v, seq_len=T) # cos, sin: (1, T, hs)
+            
+            # Adjust dims for broadcasting: (1, 1, T, hs)
+            cos = cos.unsqueeze(1)
+            sin = sin.unsqueeze(1)
+            
+            if HAS_FUSED_ROPE and q.is_cuda:
+                q, k = fused_rotary_pos_emb(q, k, cos, sin)
+            else:
+                q, k = apply_rotary_pos_emb(q, k, cos, sin)
+            attn_mask, is_causal = None, True
+        else:
+            # Incremental decoding: append to the cached window and evict the oldest
+            # entries beyond block_size. Keys are cached before RoPE and rotated here
+            # with window positions 0..L-1, so eviction keeps positions consistent.
+            past_k, past_v = past_kv
+            k = torch.cat([past_k, k], dim=2)[:, :, -self.block_size:]
+            v = torch.cat([past_v, v], dim=2)[:, :, -self.block_size:]
+            present = (k, v)
+            L = k.size(2)
+
+            cos, sin = self.rotary(v, seq_len=L)
+            cos = cos.unsqueeze(1)
+            sin = sin.unsqueeze(1)
+            k = apply_rotary(k, cos, sin)
+            q = apply_rotary(q, cos[:, :, L - T:], sin[:, :, L - T:])
+            # The new queries sit at the end of the window: a single query sees every key,
+            # several need a bottom-right aligned causal mask
+            attn_mask = None if T == 1 else torch.ones(T, L, dtype=torch.bool, device=x.device).tril(L - T)
+            is_causal = False
+
+        # Fused attention (FlashAttention / memory-efficient kernels where available)
+        y = F.scaled_dot_product_attention(
+            q, k, v,
+            attn_mask=attn_mask,
+            dropout_p=self.dropout if self.training else 0.0,
+            is_causal=is_causal,
+        )  # (B, n_heads, T, head_dim)
         y = y.transpose(1, 2).contiguous().view(B, T, C)  # (B, T, C)
         y = self.o_proj(y)
         y = self.resid_drop(y)
-        return y
+        return y, present
 
 
 # -----------------------------
@@ -243,11 +286,17 @@ class BinaryMLP(nn.Module):
         self.w3 = Linear(config.d_model, hidden_dim, bias=False) # value
         self.w2 = Linear(hidden_dim, config.d_model, bias=False) # output
         
-        self.dropout = nn.Dropout(config.dropout)
+        self.dropout = make_dropout(config.dropout)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         # SwiGLU: w2(F.silu(w1(x)) * w3(x))
-        return self.w2(F.silu(self.w1(x)) * self.w3(x))
+        a = self.w1(x)
+        b = self.w3(x)
+        if HAS_FUSED_SWIGLU and a.is_cuda:
+            h = swiglu_fused(a, b)
+        else:
+            h = F.silu(a) * b
+        return self.w2(h)
 
 
 # -----------------------------
@@ -265,12 +314,50 @@ class BinaryTransformerBlock(nn.Module):
     def forward(
         self,
         x: torch.Tensor,
-        mask: Optional[torch.Tensor] = None,
-    ) -> torch.Tensor:
+        past_kv: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    ) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
         # Pre-norm: x = x + attn(ln(x))
-        x = x + self.attn(self.ln1(x), mask=mask)
+        h, present = self.attn(self.ln1(x), past_kv=past_kv)
+        x = x + h
         x = x + self.mlp(self.ln2(x))
-        return x
+        return x, present
+
+
+# -----------------------------
+# Loss
+# -----------------------------
+
+def _linear_cross_entropy_sum(h: torch.Tensor, weight: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
+    return F.cross_entropy(F.linear(h, weight).float(), targets, reduction="sum")
+
+
+def linear_cross_entropy(
+    h: torch.Tensor,
+    weight: torch.Tensor,
+    targets: torch.Tensor,
+    chunk_size: int = 4096,
+) -> torch.Tensor:
+    """
+    Mean cross-entropy of the LM head F.linear(h, weight) over (N, C) hidden states,
+    chunk_size rows at a time, without materializing the (N, V) logits.
+
+    Each chunk's projection and FP32 softmax run inside a checkpoint, so at most
+    chunk_size * V logits exist at once and they are recomputed in backward
+    instead of being stored for all N rows.
+    """
+    n = h.size(0)
+    if n <= chunk_size:
+        return _linear_cross_entropy_sum(h, weight, targets) / n
+    total = h.new_zeros((), dtype=torch.float32)
+    for i in range(0, n, chunk_size):
+        total = total + checkpoint(
+            _linear_cross_entropy_sum,
+            h[i : i + chunk_size],
+            weight,
+            targets[i : i + chunk_size],
+            use_reentrant=False,
+        )
+    return total / n
 
 
 # -----------------------------
@@ -286,7 +373,9 @@ class BitAstroGPT(nn.Module):
     - N binary-attention blocks
     - Final LN + output head
 
-    Forward returns (logits, loss) if targets is provided.
+    Forward returns (logits, loss), and (logits, loss, past_kv) when use_cache=True.
+    With targets the loss is computed straight from the final hidden states and
+    logits is None.
     """
 
     def __init__(self, config: BitAstroConfig):
@@ -304,7 +393,7 @@ class BitAstroGPT(nn.Module):
         # You can make this BinaryLinear as well, but keeping it float helps a bit in practice.
         self.lm_head = nn.Linear(config.d_model, config.vocab_size, bias=False)
 
-        self.dropout = nn.Dropout(config.dropout)
+        self.dropout = make_dropout(config.dropout)
 
         self.apply(self._init_weights)
 
@@ -328,47 +417,53 @@ class BitAstroGPT(nn.Module):
         self,
         idx: torch.Tensor,
         targets: Optional[torch.Tensor] = None,
-    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        past_kv: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None,
+        use_cache: bool = False,
+    ):
         """
         idx: (B, T) token indices
         targets: (B, T) token indices (next token), optional
+        past_kv: per-layer (k, v) from a previous use_cache=True call; idx then
+                 holds only the new tokens
         """
 
         B, T = idx.shape
         assert T <= self.config.block_size, "Sequence length exceeds block_size"
 
-        device = idx.device
-
         # Token + positional embeddings
         # pos = torch.arange(0, T, device=device).unsqueeze(0)  # (1, T)
         x = self.token_emb(idx) # + self.pos_emb(pos)           # (B, T, C)
         x = self.dropout(x)
 
-        # Causal mask for self-attention (1, 1, T, T)
-        mask = torch.tril(torch.ones(T, T, device=device, dtype=torch.bool))
-        mask = mask.view(1, 1, T, T)
-
         # Transformer blocks
-        for block in self.blocks:
-            x = block(x, mask=mask)
+        present: List[Tuple[torch.Tensor, torch.Tensor]] = []
+        for i, block in enumerate(self.blocks):
+            x, kv = block(x, past_kv=past_kv[i] if past_kv is not None else None)
+            present.append(kv)
 
         x = self.ln_f(x)
-        logits = self.lm_head(x)  # (B, T, vocab_size)
 
+        logits: Optional[torch.Tensor] = None
         loss: Optional[torch.Tensor] = None
         if targets is not None:
-            loss = F.cross_entropy(
-                logits.view(-1, self.config.vocab_size),
+            # Fused head + loss: the (B, T, vocab_size) logits are never built
+            loss = linear_cross_entropy(
+                x.view(-1, self.config.d_model),
+                self.lm_head.weight,
                 targets.view(-1),
             )
+        else:
+            logits = self.lm_head(x)  # (B, T, vocab_size)
 
+        if use_cache:
+            return logits, loss, present
         return logits, loss
 
     # -------------------------
     # Sampling helper
     # -------------------------
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def generate(
         self,
         idx: torch.Tensor,
@@ -385,11 +480,12 @@ class BitAstroGPT(nn.Module):
         self.eval()
         B, T_start = idx.shape
 
-        for _ in range(max_new_tokens):
-            # Crop to block_size if needed
-            idx_cond = idx[:, -self.config.block_size :]
+        # Prefill on the (cropped) context, then feed one token at a time through the KV cache
+        idx_cond = idx[:, -self.config.block_size :]
+        past_kv = None
 
-            logits, _ = self(idx_cond)  # (B, T_cond, vocab_size)
+        for _ in range(max_new_tokens):
+            logits, _, past_kv = self(idx_cond, past_kv=past_kv, use_cache=True)  # (B, T_cond, vocab_size)
             logits = logits[:, -1, :] / max(temperature, 1e-6)  # (B, vocab_size)
 
             if top_k is not None and top_k > 0:
@@ -401,5 +497,6 @@ class BitAstroGPT(nn.Module):
             next_token = torch.multinomial(probs, num_samples=1)  # (B, 1)
 
             idx = torch.cat([idx, next_token], dim=1)
+            idx_cond = next_token
 
         return idx
@@ -0,0 +1,89 @@
+import torch
+
+from .triton_compat import HAS_TRITON, triton, tl
+
+
+if HAS_TRITON:
+    @triton.jit
+    def _rope_kernel(
+        q_ptr, k_ptr, cos_ptr, sin_ptr, q_out_ptr, k_out_ptr,
+        n_heads, seq_len,
+        stride_qb, stride_qh, stride_qt,
+        stride_kb, stride_kh, stride_kt,
+        stride_ct,
+        HALF: tl.constexpr, BLOCK: tl.constexpr,
+    ):
+        # One program per (batch * head, position): rotate q and k in registers, write once
+        pid_bh = tl.program_id(0)
+        t = tl.program_id(1)
+        b = pid_bh // n_heads
+        h = pid_bh % n_heads
+
+        offs = tl.arange(0, BLOCK)
+        m = offs < HALF
+
+        c_base = cos_ptr + t * stride_ct
+        s_base = sin_ptr + t * stride_ct
+        cos1 = tl.load(c_base + offs, mask=m).to(tl.float32)
+        cos2 = tl.load(c_base + HALF + offs, mask=m).to(tl.float32)
+        sin1 = tl.load(s_base + offs, mask=m).to(tl.float32)
+        sin2 = tl.load(s_base + HALF + offs, mask=m).to(tl.float32)
+
+        out_off = (pid_bh * seq_len + t) * (2 * HALF)
+
+        q_base = q_ptr + b * stride_qb + h * stride_qh + t * stride_qt
+        q1 = tl.load(q_base + offs, mask=m).to(tl.float32)
+        q2 = tl.load(q_base + HALF + offs, mask=m).to(tl.float32)
+        tl.store(q_out_ptr + out_off + offs, (q1 * cos1 - q2 * sin1).to(q_out_ptr.dtype.element_ty), mask=m)
+        tl.store(q_out_ptr + out_off + HALF + offs, (q2 * cos2 + q1 * sin2).to(q_out_ptr.dtype.element_ty), mask=m)
+
+        k_base = k_ptr + b * stride_kb + h * stride_kh + t * stride_kt
+        k1 = tl.load(k_base + offs, mask=m).to(tl.float32)
+        k2 = tl.load(k_base + HALF + offs, mask=m).to(tl.float32)
+        tl.store(k_out_ptr + out_off + offs, (k1 * cos1 - k2 * sin1).to(k_out_ptr.dtype.element_ty), mask=m)
+        tl.store(k_out_ptr + out_off + HALF + offs, (k2 * cos2 + k1 * sin2).to(k_out_ptr.dtype.element_ty), mask=m)
+
+
+def _rope(q, k, cos, sin):
+    # q, k: (B, nh, T, hs); cos, sin: (1, 1, T, hs) as built in BinarySelfAttention
+    B, nh, T, hs = q.shape
+    if q.stride(-1) != 1:
+        q = q.contiguous()
+    if k.stride(-1) != 1:
+        k = k.contiguous()
+    cos = cos.reshape(T, hs).contiguous()
+    sin = sin.reshape(T, hs).contiguous()
+    q_out = torch.empty((B, nh, T, hs), dtype=q.dtype, device=q.device)
+    k_out = torch.empty((B, nh, T, hs), dtype=k.dtype, device=k.device)
+    half = hs // 2
+    _rope_kernel[(B * nh, T)](
+        q, k, cos, sin, q_out, k_out,
+        nh, T,
+        q.stride(0), q.stride(1), q.stride(2),
+        k.stride(0), k.stride(1), k.stride(2),
+        cos.stride(0),
+        HALF=half, BLOCK=triton.next_power_of_2(half),
+    )
+    return q_out, k_out
+
+
+class _FusedRotaryPosEmb(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, q, k, cos, sin):
+        ctx.save_for_backward(cos, sin)
+        return _rope(q, k, cos, sin)
+
+    @staticmethod
+    def backward(ctx, grad_q, grad_k):
+        # The rotation is orthogonal: its gradient is the rotation by -theta
+        cos, sin = ctx.saved_tensors
+        grad_q, grad_k = _rope(grad_q, grad_k, cos, -sin)
+        return grad_q, grad_k, None, None
+
+
+def fused_rotary_pos_emb(q, k, cos, sin):
+    """
+    Single-kernel equivalent of model.apply_rotary_pos_emb for (B, nh, T, hs) q/k.
+    Requires Triton and CUDA tensors; check HAS_TRITON and q.is_cuda before calling.
+    """
+    return _FusedRotaryPosEmb.apply(q, k, cos, sin)
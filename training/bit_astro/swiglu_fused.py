@@ -0,0 +1,62 @@
+import torch
+
+from .triton_compat import HAS_TRITON, triton, tl
+
+_BLOCK = 1024
+
+
+if HAS_TRITON:
+    @triton.jit
+    def _swiglu_fwd_kernel(a_ptr, b_ptr, out_ptr, n, BLOCK: tl.constexpr):
+        # out = silu(a) * b, reading each gate/value element once and writing only the product
+        offs = tl.program_id(0) * BLOCK + tl.arange(0, BLOCK)
+        m = offs < n
+        a = tl.load(a_ptr + offs, mask=m).to(tl.float32)
+        b = tl.load(b_ptr + offs, mask=m).to(tl.float32)
+        out = a * tl.sigmoid(a) * b
+        tl.store(out_ptr + offs, out.to(out_ptr.dtype.element_ty), mask=m)
+
+    @triton.jit
+    def _swiglu_bwd_kernel(a_ptr, b_ptr, g_ptr, da_ptr, db_ptr, n, BLOCK: tl.constexpr):
+        offs = tl.program_id(0) * BLOCK + tl.arange(0, BLOCK)
+        m = offs < n
+        a = tl.load(a_ptr + offs, mask=m).to(tl.float32)
+        b = tl.load(b_ptr + offs, mask=m).to(tl.float32)
+        g = tl.load(g_ptr + offs, mask=m).to(tl.float32)
+        sig = tl.sigmoid(a)
+        silu = a * sig
+        # d silu(a) / da = sig * (1 + a * (1 - sig))
+        da = g * b * sig * (1.0 + a * (1.0 - sig))
+        db = g * silu
+        tl.store(da_ptr + offs, da.to(da_ptr.dtype.element_ty), mask=m)
+        tl.store(db_ptr + offs, db.to(db_ptr.dtype.element_ty), mask=m)
+
+
+class _SwiGLU(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, a, b):
+        a = a.contiguous()
+        b = b.contiguous()
+        out = torch.empty_like(a)
+        n = a.numel()
+        _swiglu_fwd_kernel[(triton.cdiv(n, _BLOCK),)](a, b, out, n, BLOCK=_BLOCK)
+        ctx.save_for_backward(a, b)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        a, b = ctx.saved_tensors
+        grad_out = grad_out.contiguous()
+        da = torch.empty_like(a)
+        db = torch.empty_like(b)
+        n = a.numel()
+        _swiglu_bwd_kernel[(triton.cdiv(n, _BLOCK),)](a, b, grad_out, da, db, n, BLOCK=_BLOCK)
+        return da, db
+
+
+def swiglu_fused(a, b):
+    """
+    Single-kernel F.silu(a) * b for same-shaped gate/value tensors.
+    CUDA tensors only, and only when this module's HAS_TRITON is set.
+    """
+    return _SwiGLU.apply(a, b)
@@ -14,7 +14,8 @@ class TernaryQuant(nn.Module):
         # straight-through estimator for sign
         return (x >= 0).float() * 2 - 1
 
-    def forward(self, W_full):  # W_full: [out, in]
+    def ternarize(self, W_full):  # W_full: [out, in]
+        """Returns (Wq in {-1, 0, 1}, per-row alpha [out, 1]) so that W_tern = alpha * Wq."""
         with torch.no_grad():
             if self.t is None:
                 thr = 0.7 * W_full.abs().mean(dim=1, keepdim=True)  # TWN-ish default
@@ -30,6 +31,10 @@ class TernaryQuant(nn.Module):
         nz = (Wq != 0).float()
         denom = nz.sum(dim=1, keepdim=True).clamp_min(1.0)
         alpha = (W_full.abs() * nz).sum(dim=1, keepdim=True) / denom
+        return Wq, alpha
+
+    def forward(self, W_full):  # W_full: [out, in]
+        Wq, alpha = self.ternarize(W_full)
         W_tern = alpha * Wq
         # STE backward
         if self.training:
@@ -39,11 +44,60 @@ class TernaryQuant(nn.Module):
 class TernaryLinear(nn.Module):
     def __init__(self, in_features, out_features, bias=False):
         super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
         self.weight = nn.Parameter(torch.empty(out_features, in_features))
         self.bias = nn.Parameter(torch.zeros(out_features)) if bias else None
         nn.init.kaiming_uniform_(self.weight, a=5**0.5)
         self.quant = TernaryQuant(out_features, learn_thresh=True)
+        # alpha * Wq, built on the first eval forward and reused while the weights are frozen.
+        # A non-persistent buffer so .to(device) moves it but checkpoints never see it.
+        self.register_buffer("cached_Wq", None, persistent=False)
+
+    def train(self, mode: bool = True):
+        self.cached_Wq = None
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.cached_Wq = None
+        super()._load_from_state_dict(*args, **kwargs)
 
     def forward(self, x):
-        Wq = self.quant(self.weight)
+        if self.training:
+            Wq = self.quant(self.weight)
+        else:
+            if self.cached_Wq is None:
+                with torch.no_grad():
+                    self.cached_Wq = self.quant(self.weight)
+            Wq = self.cached_Wq
         return F.linear(x, Wq, self.bias)
+
+class QuantizedTernaryLinear(nn.Module):
+    """
+    Inference-only TernaryLinear: int8 {-1, 0, 1} weights plus a per-output-row
+    FP32 scale, 4x smaller than baking alpha * Wq into an FP32 nn.Linear.
+    Build it with from_ternary().
+    """
+    def __init__(self, in_features, out_features, bias=False):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight_int8", torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer("weight_scale", torch.ones(out_features))
+        self.bias = nn.Parameter(torch.zeros(out_features), requires_grad=False) if bias else None
+
+    @classmethod
+    @torch.no_grad()
+    def from_ternary(cls, layer: TernaryLinear) -> "QuantizedTernaryLinear":
+        Wq, alpha = layer.quant.ternarize(layer.weight)
+        q = cls(layer.in_features, layer.out_features, bias=layer.bias is not None)
+        q.weight_int8.copy_(Wq.to(torch.int8))
+        q.weight_scale.copy_(alpha.view(-1))
+        if layer.bias is not None:
+            q.bias.copy_(layer.bias)
+        return q
+
+    def forward(self, x):
+        # x @ (alpha * Wq).T == (x @ Wq.T) * alpha, so the matmul only sees {-1, 0, 1}
+        y = F.linear(x, self.weight_int8.to(x.dtype)) * self.weight_scale.to(x.dtype)
+        return y if self.bias is None else y + self.bias
@@ -1,16 +1,40 @@
 import os
 import json
+import heapq
 import re
+import numpy as np
 from typing import List, Dict, Tuple
 
 # Minimal BPE implementation
 # Inspired by minbpe / karpathy
 
+def _byte_pair_stats(text_bytes: bytes):
+    """
+    Counts adjacent byte pairs and collects their left positions with NumPy.
+    Pairs are packed as (a << 8) | b, grouped by a stable argsort, and turned into
+    Python containers once per distinct pair (at most 65536) rather than once per byte.
+    """
+    arr = np.frombuffer(text_bytes, dtype=np.uint8).astype(np.int32)
+    keys = (arr[:-1] << 8) | arr[1:]
+    order = np.argsort(keys, kind="stable")
+    uniq, starts, sizes = np.unique(keys[order], return_index=True, return_counts=True)
+    order = order.tolist()
+    counts = {} # (idx1, idx2) -> count
+    positions = {} # (idx1, idx2) -> set of left positions
+    for key, start, size in zip(uniq.tolist(), starts.tolist(), sizes.tolist()):
+        pair = (key >> 8, key & 0xFF)
+        counts[pair] = size
+        positions[pair] = set(order[start : start + size])
+    return counts, positions
+
+_NO_RANK = np.iinfo(np.int32).max
+
 class BPETokenizer:
     def __init__(self):
         self.merges = {} # (int, int) -> int
         self.vocab = {}  # int -> bytes
         self.special_tokens = {} # str -> int
+        self._byte_ranks = None # lazily built (256, 256) merge-rank table for byte pairs
         # Simplified pattern for standard re
         self.pattern = re.compile(r"""\s+|[a-zA-Z]+|[0-9]+|[^a-zA-Z0-9\s]+""")
 
@@ -20,39 +44,147 @@ class BPETokenizer:
         
         # Input text preprocessing
         text_bytes = text.encode("utf-8")
-        ids = list(text_bytes) # list of integers in range 0..255
+        tok = list(text_bytes) # list of integers in range 0..255, -1 once merged away
+        n = len(tok)
+
+        # Doubly-linked list over positions so a merge only touches its neighbours
+        prev = list(range(-1, n - 1))
+        nxt = list(range(1, n + 1))
+        if n:
+            nxt[-1] = -1
+
+        # Pair counts plus the left positions where each pair occurs
+        counts, positions = _byte_pair_stats(text_bytes)
+
+        # Max-heap keyed by count; stale entries are skipped lazily on pop
+        heap = [(-c, pair) for pair, c in counts.items()]
+        heapq.heapify(heap)
+
+        def remove(pair, pos):
+            counts[pair] -= 1
+            sites = positions.get(pair)
+            if sites is not None:
+                sites.discard(pos)
+
+        def add(pair, pos):
+            counts[pair] = counts.get(pair, 0) + 1
+            if pair in positions:
+                positions[pair].add(pos)
+            else:
+                positions[pair] = {pos}
 
         # Iteratively merge the most common pair
         merges = {} # (idx1, idx2) -> idx_new
         vocab = {idx: bytes([idx]) for idx in range(256)} # int -> bytes
         
         for i in range(num_merges):
-            stats = self._get_stats(ids)
-            if not stats:
+            pair = None
+            while heap:
+                neg_count, candidate = heapq.heappop(heap)
+                if counts.get(candidate, 0) == -neg_count and neg_count < 0:
+                    pair = candidate
+                    break
+            if pair is None:
                 break
-            pair = max(stats, key=stats.get)
             idx = 256 + i
-            ids = self._merge(ids, pair, idx)
+            a, b = pair
+            touched = set()
+            # Left-to-right so overlapping occurrences (e.g. "aaa") merge like a linear scan
+            for pos in sorted(positions.pop(pair)):
+                j = nxt[pos]
+                if tok[pos] != a or j == -1 or tok[j] != b:
+                    continue # consumed by an earlier merge in this pass
+                p, k = prev[pos], nxt[j]
+                if p != -1:
+                    remove((tok[p], a), p)
+                    touched.add((tok[p], a))
+                if k != -1:
+                    remove((b, tok[k]), j)
+                    touched.add((b, tok[k]))
+                # splice out j
+                tok[pos] = idx
+                tok[j] = -1
+                nxt[pos] = k
+                if k != -1:
+                    prev[k] = pos
+                if p != -1:
+                    add((tok[p], idx), p)
+                    touched.add((tok[p], idx))
+                if k != -1:
+                    add((idx, tok[k]), pos)
+                    touched.add((idx, tok[k]))
+            del counts[pair]
+            touched.discard(pair)
+            for t in touched:
+                c = counts[t]
+                if c > 0:
+                    heapq.heappush(heap, (-c, t))
+                else:
+                    del counts[t]
+                    positions.pop(t, None)
             merges[pair] = idx
-            vocab[idx] = vocab[pair[0]] + vocab[pair[1]]
+            vocab[idx] = vocab[a] + vocab[b]
             if verbose:
                 print(f"merge {i+1}/{num_merges}: {pair} -> {idx} ({vocab[idx]})")
 
         self.merges = merges
         self.vocab = vocab
         self.vocab_size = 256 + len(merges)
+        self._byte_ranks = None
 
     def encode(self, text: str) -> List[int]:
         text_bytes = text.encode("utf-8")
-        ids = list(text_bytes)
-        while len(ids) >= 2:
-            stats = self._get_stats(ids)
-            pair = min(stats, key=lambda p: self.merges.get(p, float("inf")))
-            if pair not in self.merges:
-                break # no more merges available
-            idx = self.merges[pair]
-            ids = self._merge(ids, pair, idx)
-        return ids
+        ids = list(text_bytes) # -1 once merged away
+        n = len(ids)
+        merges = self.merges
+        if n < 2 or not merges:
+            return ids
+
+        # Same linked list as train; a min-heap of (rank, position) replaces the
+        # full rescan for the lowest-rank pair. Merges only ever create pairs of
+        # higher rank, so popping by rank then position reproduces the
+        # merge-everything-in-rank-order result exactly.
+        prev = list(range(-1, n - 1))
+        nxt = list(range(1, n + 1))
+        nxt[-1] = -1
+        heap = self._initial_heap(text_bytes)
+
+        while heap:
+            rank, pos = heapq.heappop(heap)
+            j = nxt[pos]
+            if j == -1 or merges.get((ids[pos], ids[j])) != rank:
+                continue # stale: one side was merged already
+            k = nxt[j]
+            ids[pos] = rank
+            ids[j] = -1
+            nxt[pos] = k
+            if k != -1:
+                prev[k] = pos
+                new_rank = merges.get((rank, ids[k]))
+                if new_rank is not None:
+                    heapq.heappush(heap, (new_rank, pos))
+            p = prev[pos]
+            if p != -1:
+                new_rank = merges.get((ids[p], rank))
+                if new_rank is not None:
+                    heapq.heappush(heap, (new_rank, p))
+        return [t for t in ids if t != -1]
+
+    def _initial_heap(self, text_bytes: bytes) -> List[Tuple[int, int]]:
+        # Vectorized rank lookup for every adjacent byte pair via a 256x256 table;
+        # sorting by (rank, position) already satisfies the heap invariant
+        if self._byte_ranks is None:
+            table = np.full((256, 256), _NO_RANK, dtype=np.int32)
+            for (p0, p1), idx in self.merges.items():
+                if p0 < 256 and p1 < 256:
+                    table[p0, p1] = idx
+            self._byte_ranks = table
+        arr = np.frombuffer(text_bytes, dtype=np.uint8)
+        ranks = self._byte_ranks[arr[:-1], arr[1:]]
+        pos = np.flatnonzero(ranks != _NO_RANK)
+        ranks = ranks[pos]
+        order = np.lexsort((pos, ranks))
+        return list(zip(ranks[order].tolist(), pos[order].tolist()))
 
     def decode(self, ids: List[int]) -> str:
         tokens = b"".join(self.vocab[idx] for idx in ids if idx in self.vocab)
@@ -74,6 +206,7 @@ class BPETokenizer:
             
         self.merges = {}
         self.vocab = {idx: bytes([idx]) for idx in range(256)}
+        self._byte_ranks = None
         
         with open(merges_file, 'r', encoding='utf-8') as f:
             for line in f:
@@ -87,6 +220,7 @@ class BPETokenizer:
 
     def load_state_dict(self, merges: Dict[Tuple[int, int], int]):
         self.merges = merges
+        self._byte_ranks = None
         self.vocab = {idx: bytes([idx]) for idx in range(256)}
         for (p0, p1), idx in self.merges.items():
             self.vocab[idx] = self.vocab[p0] + self.vocab[p1]
@@ -94,21 +228,3 @@ class BPETokenizer:
 
     def __len__(self):
         return self.vocab_size
-
-    def _get_stats(self, ids):
-        counts = {}
-        for pair in zip(ids, ids[1:]):
-            counts[pair] = counts.get(pair, 0) + 1
-        return counts
-
-    def _merge(self, ids, pair, idx):
-        newids = []
-        i = 0
-        while i < len(ids):
-            if i < len(ids) - 1 and ids[i] == pair[0] and ids[i+1] == pair[1]:
-                newids.append(idx)
-                i += 2
-            else:
-                newids.append(ids[i])
-                i += 1
-        return newids
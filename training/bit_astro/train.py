@@ -10,7 +10,9 @@ from torch.utils.data import DataLoader
 
 from .model import BitAstroGPT, BitAstroConfig
 from .config import default_config
-from .data import load_corpus_and_vocab, CharLMIndexedDataset
+from .data import load_corpus_and_vocab, load_prepared_vocab, CharLMIndexedDataset, MemmapLMDataset, collate_prebatched
+
+INV_LN2 = 1.0 / math.log(2)  # nats -> bits
 
 def set_seed(seed: int):
     random.seed(seed)
@@ -18,9 +20,46 @@ def set_seed(seed: int):
     if torch.cuda.is_available():
         torch.cuda.manual_seed_all(seed)
 
+def _inf(loader):
+    # Endless batches; with persistent workers the workers stay warm across epochs
+    while True:
+        yield from loader
+
+def prefetch_to_device(loader, device):
+    """
+    Yield (x, y) batches already on `device`. On CUDA the copy of the next batch is
+    issued non_blocking on a side stream, so it overlaps the current step's compute.
+    """
+    if "cuda" not in device:
+        for x, y in loader:
+            yield x.to(device), y.to(device)
+        return
+
+    copy_stream = torch.cuda.Stream()
+
+    def issue(batch):
+        with torch.cuda.stream(copy_stream):
+            return tuple(t.to(device, non_blocking=True) for t in batch)
+
+    pending = None
+    for batch in loader:
+        nxt = issue(batch)
+        if pending is not None:
+            yield pending
+        # Compute must see the finished copy; record_stream keeps the allocator from
+        # recycling the buffers while the compute stream still uses them
+        compute_stream = torch.cuda.current_stream()
+        compute_stream.wait_stream(copy_stream)
+        for t in nxt:
+            t.record_stream(compute_stream)
+        pending = nxt
+    if pending is not None:
+        yield pending
+
 def main():
     parser = argparse.ArgumentParser(description="Train BitAstroGPT")
     parser.add_argument("--data-path", type=str, default="../data/corpus.txt", help="Path to corpus file")
+    parser.add_argument("--data-dir", type=str, default=None, help="Directory written by scripts/prepare_data.py (overrides --data-path)")
     parser.add_argument("--block-size", type=int, default=256, help="Block size (context length)")
     parser.add_argument("--batch-size", type=int, default=32, help="Batch size")
     parser.add_argument("--max-steps", type=int, default=1000, help="Maximum training steps")
@@ -35,34 +74,66 @@ def main():
     parser.add_argument("--seed", type=int, default=1337, help="Random seed")
     parser.add_argument("--use-ternary", type=str, default="true", help="Use ternary weights (true/false)")
     parser.add_argument("--amp", type=str, default="true", help="Use mixed precision (true/false)")
+    parser.add_argument("--dtype", type=str, default="bf16", choices=["fp16", "bf16", "fp32"], help="Autocast dtype when AMP is on")
     parser.add_argument("--tokenizer", type=str, default="char", choices=["char", "bpe"], help="Tokenizer type")
+    parser.add_argument("--compile", type=str, default="false", help="torch.compile the model (true/false)")
+    parser.add_argument("--num-workers", type=int, default=min(8, os.cpu_count() or 1), help="DataLoader worker processes (0 loads in the main process)")
+    parser.add_argument("--prefetch-factor", type=int, default=4, help="Batches each DataLoader worker keeps in flight")
 
     args = parser.parse_args()
     
     # Parse booleans
     args.use_ternary = args.use_ternary.lower() == "true"
     args.amp = args.amp.lower() == "true"
+    args.compile = args.compile.lower() == "true"
+
+    # bf16 keeps the fp32 exponent range, so it trains without a GradScaler.
+    # fp16 is the fallback for GPUs without native bf16 (pre-Ampere; the default
+    # is_bf16_supported() also counts emulation); CPU autocast is bf16 only.
+    if args.dtype == "fp32":
+        args.amp = False
+    use_fp16 = "cuda" in args.device and (
+        args.dtype == "fp16" or not torch.cuda.is_bf16_supported(including_emulation=False)
+    )
+    amp_dtype = torch.float16 if use_fp16 else torch.bfloat16
 
     set_seed(args.seed)
-    print(f"Using device: {args.device} | AMP: {args.amp} | Ternary: {args.use_ternary}")
+    amp_desc = str(amp_dtype).replace("torch.", "") if args.amp else "off"
+    print(f"Using device: {args.device} | AMP: {amp_desc} | Ternary: {args.use_ternary}")
 
     # 1. Load Data
-    print(f"Loading data from {args.data_path}...")
-    vocab, tokens = load_corpus_and_vocab(args.data_path, args.block_size, tokenizer_type=args.tokenizer)
-    print(f"Vocab size: {len(vocab)}")
-    print(f"Total tokens: {len(tokens)}")
-
-    # 2. Split Data (90/10)
-    n = len(tokens)
-    train_data = tokens[:int(n*0.9)]
-    val_data = tokens[int(n*0.9):]
-    
-    # Use packed dataset for training
-    train_dataset = CharLMIndexedDataset(train_data, args.block_size, packed=True)
-    val_dataset = CharLMIndexedDataset(val_data, args.block_size, packed=True)
+    if args.data_dir:
+        # Pre-tokenized uint16 splits, memory-mapped lazily by each loader worker
+        print(f"Loading prepared data from {args.data_dir}...")
+        vocab, args.tokenizer = load_prepared_vocab(args.data_dir)
+        train_dataset = MemmapLMDataset(os.path.join(args.data_dir, "train.bin"), args.block_size, packed=True)
+        val_dataset = MemmapLMDataset(os.path.join(args.data_dir, "val.bin"), args.block_size, packed=True)
+        print(f"Vocab size: {len(vocab)}")
+        print(f"Total tokens: {train_dataset.num_tokens + val_dataset.num_tokens}")
+    else:
+        print(f"Loading data from {args.data_path}...")
+        vocab, tokens = load_corpus_and_vocab(args.data_path, args.block_size, tokenizer_type=args.tokenizer)
+        print(f"Vocab size: {len(vocab)}")
+        print(f"Total tokens: {len(tokens)}")
+
+        # 2. Split Data (90/10)
+        n = len(tokens)
+        train_data = tokens[:int(n*0.9)]
+        val_data = tokens[int(n*0.9):]
+        
+        # Use packed dataset for training
+        train_dataset = CharLMIndexedDataset(train_data, args.block_size, packed=True)
+        val_dataset = CharLMIndexedDataset(val_data, args.block_size, packed=True)
     
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, pin_memory=True)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, pin_memory=True)
+    # The datasets batch themselves via __getitems__, so collation is a pass-through
+    # drop_last keeps every batch the same shape, so a compiled model never recompiles
+    # Workers stay alive across epochs/evals; prefetch_factor is only valid with workers
+    loader_kwargs = dict(batch_size=args.batch_size, pin_memory=True, collate_fn=collate_prebatched, num_workers=args.num_workers)
+    if args.num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=args.prefetch_factor)
+    train_loader = DataLoader(train_dataset, shuffle=True, drop_last=True, **loader_kwargs)
+    val_loader = DataLoader(val_dataset, shuffle=False, drop_last=True, **loader_kwargs)
+    assert len(val_loader) > 0, "validation split is smaller than one batch; lower --batch-size"
 
     # 3. Setup Model
     config = default_config(vocab_size=len(vocab), block_size=args.block_size)
@@ -71,61 +142,77 @@ def main():
     
     model = BitAstroGPT(config)
     model.to(args.device)
+    raw_model = model  # uncompiled handle, so checkpoints keep plain (non-_orig_mod.) keys
     
-    # Optional: Compile if available and working (disabled for stability on Windows)
-    # if hasattr(torch, "compile"):
-    #     print("Compiling model...")
-    #     model = torch.compile(model)
+    # Optional: Compile if available and working (off by default for stability on Windows)
+    if args.compile and hasattr(torch, "compile"):
+        print("Compiling model (the first step includes compile time)...")
+        # Room for the train and eval graphs (and their variants) without falling back to eager
+        torch._dynamo.config.cache_size_limit = 16
+        model = torch.compile(model, mode="reduce-overhead", fullgraph=False, dynamic=False)
 
-    optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    # The fused kernel needs the params on CUDA
+    optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.weight_decay,
+                            betas=(0.9, 0.95), fused="cuda" in args.device)
     
-    # Cosine scheduler with warmup
-    def get_lr(it):
-        if it < args.warmup_steps:
-            return args.lr * (it + 1) / (args.warmup_steps + 1)
-        if it > args.max_steps:
-            return args.lr * 0.1
-        decay_ratio = (it - args.warmup_steps) / (args.max_steps - args.warmup_steps)
-        coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio))
-        return args.lr * 0.1 + coeff * (args.lr - 0.1 * args.lr)
+    # Linear warmup then cosine decay to 10% of the peak LR, stepped once per iteration
+    warmup = optim.lr_scheduler.LinearLR(optimizer, start_factor=1.0 / (args.warmup_steps + 1), end_factor=1.0,
+                                         total_iters=args.warmup_steps)
+    cosine = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=max(1, args.max_steps - args.warmup_steps),
+                                                  eta_min=args.lr * 0.1)
+    scheduler = optim.lr_scheduler.SequentialLR(optimizer, [warmup, cosine], milestones=[args.warmup_steps])
 
     # 4. Training Loop
     os.makedirs(args.checkpoint_dir, exist_ok=True)
     best_val_bpc = float('inf')
     
-    train_iter = iter(train_loader)
-    scaler = torch.cuda.amp.GradScaler(enabled=args.amp)
+    train_iter = prefetch_to_device(_inf(train_loader), args.device)
+    # Loss scaling only matters for CUDA fp16; elsewhere it would just add unscale passes
+    scaler = torch.amp.GradScaler("cuda", enabled=args.amp and amp_dtype == torch.float16)
     
+    # One autocast context, built once and re-entered by the train and eval steps
+    dev_type = "cuda" if "cuda" in args.device else "cpu"
+    autocast_ctx = torch.amp.autocast(device_type=dev_type, enabled=args.amp, dtype=amp_dtype)
+
     model.train()
     t0 = time.time()
     
     for step in range(args.max_steps):
-        # Update LR
-        lr = get_lr(step)
-        for param_group in optimizer.param_groups:
-            param_group['lr'] = lr
-            
-        try:
-            x, y = next(train_iter)
-        except StopIteration:
-            train_iter = iter(train_loader)
-            x, y = next(train_iter)
-            
-        x, y = x.to(args.device), y.to(args.device)
+        optimizer.zero_grad(set_to_none=True)
+
+        x, y = next(train_iter)
+        assert x.shape == (args.batch_size, args.block_size), f"unexpected batch shape {tuple(x.shape)}"
         
         # Forward backward with AMP
-        with torch.amp.autocast(device_type="cuda" if "cuda" in args.device else "cpu", enabled=args.amp):
-            logits, loss = model(x, targets=y)
+        with autocast_ctx:
+            _, loss = model(x, targets=y)
         
-        scaler.scale(loss).backward()
-        
-        # Gradient clipping
-        scaler.unscale_(optimizer)
+        if scaler.is_enabled():
+            scaler.scale(loss).backward()
+            # Gradient clipping on the unscaled grads
+            scaler.unscale_(optimizer)
+        else:
+            loss.backward()
         grad_norm = utils.clip_grad_norm_(model.parameters(), args.grad_clip)
-        
-        scaler.step(optimizer)
-        scaler.update()
-        optimizer.zero_grad()
+
+        # Never step on inf/nan grads (clipping cannot fix them). The scaler still
+        # updates, so fp16 overflow backs off the loss scale as usual.
+        if torch.isfinite(grad_norm):
+            if scaler.is_enabled():
+                scaler.step(optimizer)
+            else:
+                optimizer.step()
+        else:
+            print(f"Step {step}: non-finite grad norm, skipping update")
+        if scaler.is_enabled():
+            scaler.update()
+        lr = scheduler.get_last_lr()[0] # the LR this step used, read before advancing
+        scheduler.step()
+
+        if step == 0 and args.compile:
+            if "cuda" in args.device:
+                torch.cuda.synchronize()
+            print(f"First step took {time.time() - t0:.1f}s (includes torch.compile, not a hang)")
 
         # Logging
         if step % 50 == 0:
@@ -133,23 +220,27 @@ def main():
             dt = t1 - t0
             t0 = t1
             tokens_per_sec = (args.batch_size * args.block_size * 50) / dt if dt > 0 else 0
-            bpc = loss.item() / math.log(2)
-            print(f"Step {step}: loss {loss.item():.4f} | BPC {bpc:.4f} | lr {lr:.2e} | norm {grad_norm:.2f} | tok/s {tokens_per_sec:.0f}")
+            # loss and grad_norm stay on the device between logs; read both with one sync
+            loss_val, norm_val = torch.stack([loss.detach().float(), grad_norm.detach().float()]).tolist()
+            bpc = loss_val * INV_LN2
+            print(f"Step {step}: loss {loss_val:.4f} | BPC {bpc:.4f} | lr {lr:.2e} | norm {norm_val:.2f} | tok/s {tokens_per_sec:.0f}")
 
         # Evaluation
         if (step > 0 and step % args.eval_interval == 0) or step == args.max_steps - 1:
             model.eval()
-            val_losses = []
-            with torch.no_grad():
-                for i, (xv, yv) in enumerate(val_loader):
+            # Accumulate on the device so the eval loop never waits on the GPU
+            val_loss_sum = torch.zeros((), device=args.device)
+            n_val = 0
+            with torch.inference_mode():
+                for i, (xv, yv) in enumerate(prefetch_to_device(val_loader, args.device)):
                     if i >= args.eval_iters: break
-                    xv, yv = xv.to(args.device), yv.to(args.device)
-                    with torch.amp.autocast(device_type="cuda" if "cuda" in args.device else "cpu", enabled=args.amp):
+                    with autocast_ctx:
                         _, v_loss = model(xv, targets=yv)
-                    val_losses.append(v_loss.item())
+                    val_loss_sum += v_loss.detach().float()
+                    n_val += 1
             
-            avg_val_loss = sum(val_losses) / len(val_losses) if val_losses else 0.0
-            val_bpc = avg_val_loss / math.log(2)
+            avg_val_loss = (val_loss_sum / max(n_val, 1)).item()
+            val_bpc = avg_val_loss * INV_LN2
             print(f"Step {step}: val loss {avg_val_loss:.4f} | val BPC {val_bpc:.4f}")
             
             if val_bpc < best_val_bpc:
@@ -157,7 +248,7 @@ def main():
                 checkpoint_path = os.path.join(args.checkpoint_dir, "bit_astro_best.pt")
                 print(f"Saving best checkpoint to {checkpoint_path}")
                 torch.save({
-                    'model_state_dict': model.state_dict(),
+                    'model_state_dict': raw_model.state_dict(),
                     'config': config.__dict__,
                     'vocab_stoi': getattr(vocab, 'stoi', None),
                     'vocab_itos': getattr(vocab, 'itos', None),
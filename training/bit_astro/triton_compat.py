@@ -0,0 +1,10 @@
+# Optional Triton import shared by the fused kernels (rope_fused, swiglu_fused).
+# CPU-only installs get HAS_TRITON = False and the model uses the plain PyTorch ops.
+try:
+    import triton
+    import triton.language as tl
+    HAS_TRITON = True
+except ImportError:
+    triton = None
+    tl = None
+    HAS_TRITON = False
@@ -1,8 +1,9 @@
+import argparse
 import torch
 import torch.nn as nn
 import os
 from bit_astro.model import BitAstroGPT, BitAstroConfig
-from bit_astro.ternary import TernaryLinear
+from bit_astro.ternary import TernaryLinear, QuantizedTernaryLinear
 
 class InferenceWrapper(nn.Module):
     """Wrapper that only returns logits (no loss) for clean ONNX export."""
@@ -14,42 +15,75 @@ class InferenceWrapper(nn.Module):
         logits, _ = self.model(idx, targets=None)
         return logits
 
-def bake_ternary_weights(model):
+@torch.library.custom_op("bit_astro::matmul_integer", mutates_args=())
+def matmul_integer(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    """int8 @ int8 -> int32 with zero points of 0, i.e. ONNX MatMulInteger."""
+    # Exact in fp32 while every |dot product| < 2**24, far above 127 * d_model here
+    return torch.matmul(a.float(), b.float()).to(torch.int32)
+
+@matmul_integer.register_fake
+def _(a, b):
+    return a.new_empty((*a.shape[:-1], b.shape[-1]), dtype=torch.int32)
+
+def _matmul_integer_onnx(a, b):
+    from onnxscript import opset18 as op
+    return op.MatMulInteger(a, b)
+
+class Int8MatMulTernaryLinear(QuantizedTernaryLinear):
     """
-    Replaces all TernaryLinear layers with standard nn.Linear layers
-    with the weights 'baked' in (i.e., pre-calculated ternary values).
+    QuantizedTernaryLinear that also quantizes its input (symmetric, per token) so the
+    exported graph runs the matmul as MatMulInteger on ONNX Runtime's int8 kernels.
     """
-    print("Baking ternary weights into standard Linear layers...")
-    
-    modules_to_replace = []
-    
-    for name, module in model.named_modules():
-        if isinstance(module, TernaryLinear):
-            modules_to_replace.append((name, module))
-            
-    for name, module in modules_to_replace:
-        with torch.no_grad():
-            effective_weight = module.quant(module.weight)
-        
-        in_features = module.weight.shape[1]
-        out_features = module.weight.shape[0]
-        new_layer = nn.Linear(in_features, out_features, bias=module.bias is not None)
-        
-        new_layer.weight.data = effective_weight
-        if module.bias is not None:
-            new_layer.bias.data = module.bias.data
-            
-        parent_module = model
-        path = name.split('.')
-        for part in path[:-1]:
-            parent_module = getattr(parent_module, part)
-        
-        setattr(parent_module, path[-1], new_layer)
-        print(f"  Replaced {name} with nn.Linear")
+    def forward(self, x):
+        x_scale = x.abs().amax(dim=-1, keepdim=True).clamp_min(1e-8) / 127
+        x_int8 = torch.round(x / x_scale).clamp(-127, 127).to(torch.int8)
+        y = matmul_integer(x_int8, self.weight_int8.t()).to(x.dtype) * (x_scale * self.weight_scale.to(x.dtype))
+        return y if self.bias is None else y + self.bias
+
+def _bake(module, layer_cls, prefix=""):
+    # Swap children in place during a single walk instead of re-resolving dotted names
+    for name, child in list(module.named_children()):
+        if isinstance(child, TernaryLinear):
+            setattr(module, name, layer_cls.from_ternary(child))
+            print(f"  Replaced {prefix}{name} with {layer_cls.__name__}")
+        else:
+            _bake(child, layer_cls, f"{prefix}{name}.")
 
+def bake_ternary_weights(model, int8_matmul=False):
+    """
+    Replaces all TernaryLinear layers with QuantizedTernaryLinear layers holding
+    the ternary weights as int8 {-1, 0, 1} plus a per-row FP32 scale.
+    With int8_matmul, activations are quantized too (Int8MatMulTernaryLinear).
+    """
+    layer_cls = Int8MatMulTernaryLinear if int8_matmul else QuantizedTernaryLinear
+    print(f"Baking ternary weights into int8 {layer_cls.__name__} layers...")
+    with torch.set_grad_enabled(False):
+        _bake(model, layer_cls)
     return model
 
-def export_to_onnx(checkpoint_path, output_path):
+def quantize_remaining_matmuls(onnx_path):
+    """
+    Dynamic int8 quantization (onnxruntime.quantization) of the float weight matmuls
+    left after baking, e.g. lm_head. The MatMulInteger layers are already int8.
+    """
+    try:
+        import onnx
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+    except ImportError:
+        print("onnx/onnxruntime not installed, skipping dynamic quantization")
+        return
+
+    graph = onnx.load(onnx_path).graph
+    initializers = {init.name for init in graph.initializer}
+    # Only matmuls against a stored weight; activation @ activation (attention) stays float
+    nodes = [n.name for n in graph.node if n.op_type in ("MatMul", "Gemm") and n.input[1] in initializers]
+    if not nodes:
+        print("No float weight matmuls left to quantize")
+        return
+    print(f"Dynamically quantizing {len(nodes)} remaining float matmul(s)...")
+    quantize_dynamic(onnx_path, onnx_path, weight_type=QuantType.QInt8, nodes_to_quantize=nodes)
+
+def export_to_onnx(checkpoint_path, output_path, int8_matmul=False):
     if not os.path.exists(checkpoint_path):
         print(f"Checkpoint not found at {checkpoint_path}")
         return
@@ -80,7 +114,7 @@ def export_to_onnx(checkpoint_path, output_path):
     model.load_state_dict(new_state_dict)
     model.eval()
     
-    model = bake_ternary_weights(model)
+    model = bake_ternary_weights(model, int8_matmul=int8_matmul)
     
     wrapped_model = InferenceWrapper(model)
     wrapped_model.eval()
@@ -96,7 +130,9 @@ def export_to_onnx(checkpoint_path, output_path):
         dummy_input,
         output_path,
         export_params=True,
-        opset_version=14,
+        dynamo=True,
+        opset_version=18,
+        custom_translation_table={torch.ops.bit_astro.matmul_integer.default: _matmul_integer_onnx},
         do_constant_folding=True,
         input_names=['input_ids'],
         output_names=['logits'],
@@ -134,14 +170,23 @@ def export_to_onnx(checkpoint_path, output_path):
         print(f"Merged into single file: {output_path}")
     else:
         print("All weights embedded in single ONNX file")
+
+    if int8_matmul:
+        quantize_remaining_matmuls(output_path)
     
     file_size = os.path.getsize(output_path) / (1024 * 1024)
-    print(f"Final model size: {file_size:.2f} MB")
+    ternary_params = sum(m.weight_int8.numel() for m in model.modules() if isinstance(m, QuantizedTernaryLinear))
+    print(f"Final model size: {file_size:.2f} MB "
+          f"(ternary weights: {ternary_params / (1024 * 1024):.2f} MB int8 vs {ternary_params * 4 / (1024 * 1024):.2f} MB FP32)")
     
     print("Export complete!")
     print(f"Model saved to {output_path}")
 
 if __name__ == "__main__":
-    CHECKPOINT_PATH = "checkpoints/bit_astro_best.pt"
-    OUTPUT_PATH = "bit_astro.onnx"
-    export_to_onnx(CHECKPOINT_PATH, OUTPUT_PATH)
+    parser = argparse.ArgumentParser(description="Export BitAstroGPT to ONNX")
+    parser.add_argument("--checkpoint", type=str, default="checkpoints/bit_astro_best.pt", help="Path to checkpoint")
+    parser.add_argument("--output", type=str, default="bit_astro.onnx", help="Output ONNX path")
+    parser.add_argument("--int8-matmul", type=str, default="false",
+                        help="Quantize activations and emit MatMulInteger for the ternary layers (true/false)")
+    args = parser.parse_args()
+    export_to_onnx(args.checkpoint, args.output, int8_matmul=args.int8_matmul.lower() == "true")
@@ -11,38 +11,27 @@ print(f"Dataset shape: {df.shape}")
 horoscope_texts = df['horoscope'].dropna().tolist()
 print(f"Total horoscope entries: {len(horoscope_texts)}")
 
-# Format for training - one horoscope per line
-# Add some context by including the sign
-formatted_texts = []
-for idx, row in df.iterrows():
-    sign = row['sign'].capitalize() if pd.notna(row['sign']) else ""
-    horoscope = row['horoscope'] if pd.notna(row['horoscope']) else ""
-    
-    if horoscope:
-        # Format: "sign: horoscope" or just horoscope
-        formatted_texts.append(horoscope.strip())
+# Format for training - one horoscope per line, stripped, empty entries dropped.
+# To add sign context: df.loc[mask, 'sign'].fillna('').str.capitalize() + ': ' + texts
+mask = df['horoscope'].notna()
+texts = df.loc[mask, 'horoscope'].astype(str).str.strip()
+formatted_texts = texts[texts != ''].tolist()
 
 # Write to file
 output_path = "data/hf_corpus.txt"
 with open(output_path, 'w', encoding='utf-8') as f:
-    for text in formatted_texts:
-        f.write(text + "\n")
+    f.writelines(text + "\n" for text in formatted_texts)
 
 # Check size
 file_size = os.path.getsize(output_path)
 print(f"Saved to {output_path}")
 print(f"File size: {file_size / 1024:.2f} KB ({file_size / (1024*1024):.2f} MB)")
 
-# Also append to main corpus
+# Also append to main corpus (append mode: the existing corpus is never read back)
 main_corpus = "data/corpus.txt"
-with open(main_corpus, 'r', encoding='utf-8') as f:
-    existing = f.read()
-
-with open(main_corpus, 'w', encoding='utf-8') as f:
-    f.write(existing)
+with open(main_corpus, 'a', encoding='utf-8') as f:
     f.write("\n\n# --- HuggingFace Horoscope Dataset ---\n\n")
-    for text in formatted_texts:
-        f.write(text + "\n")
+    f.writelines(text + "\n" for text in formatted_texts)
 
 final_size = os.path.getsize(main_corpus)
 print(f"Updated {main_corpus}")
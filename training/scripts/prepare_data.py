@@ -0,0 +1,51 @@
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+# Run from training/: python scripts/prepare_data.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bit_astro.data import load_corpus_and_vocab
+
+# One-time tokenization of the corpus into flat uint16 train.bin / val.bin files,
+# memory-mapped by MemmapLMDataset (train.py --data-dir) instead of re-loading the corpus
+def main():
+    parser = argparse.ArgumentParser(description="Tokenize the corpus into memory-mappable train/val files")
+    parser.add_argument("--data-path", type=str, default="../data/corpus.txt", help="Path to corpus file")
+    parser.add_argument("--out-dir", type=str, default="../data/prepared", help="Output directory")
+    parser.add_argument("--tokenizer", type=str, default="char", choices=["char", "bpe"], help="Tokenizer type")
+    args = parser.parse_args()
+
+    vocab, tokens = load_corpus_and_vocab(args.data_path, block_size=0, tokenizer_type=args.tokenizer)
+    assert len(vocab) <= 2 ** 16, f"vocab of {len(vocab)} does not fit in uint16"
+    tokens = tokens.numpy()
+    print(f"Vocab size: {len(vocab)}")
+    print(f"Total tokens: {len(tokens):,}")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    # Same 90/10 split as train.py
+    n = len(tokens)
+    splits = {"train": tokens[:int(n * 0.9)], "val": tokens[int(n * 0.9):]}
+    for name, split in splits.items():
+        out_path = os.path.join(args.out_dir, f"{name}.bin")
+        arr = np.memmap(out_path, dtype=np.uint16, mode="w+", shape=(len(split),))
+        arr[:] = split
+        arr.flush()
+        del arr
+        print(f"Saved {len(split):,} tokens to {out_path}")
+
+    # The vocab travels with the token files so train.py can rebuild it without the corpus
+    meta = {"tokenizer": args.tokenizer, "vocab_size": len(vocab)}
+    if args.tokenizer == "bpe":
+        vocab.save(os.path.join(args.out_dir, "tokenizer"))
+    else:
+        meta["chars"] = [vocab.itos[i] for i in range(len(vocab))]
+    with open(os.path.join(args.out_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    print(f"Saved vocab metadata to {os.path.join(args.out_dir, 'meta.json')}")
+
+if __name__ == "__main__":
+    main()
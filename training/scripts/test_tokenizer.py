@@ -1,3 +1,4 @@
+import sys
 from trainer.bit_astro.tokenizer import BPETokenizer
 
 tokenizer = BPETokenizer()
@@ -11,5 +12,5 @@ decoded = tokenizer.decode(ids)
 print(f"Decoded: '{decoded}'")
 
 print("Sample tokens:")
-for i in range(256, 300):
-    print(f"{i}: {tokenizer.vocab[i]}")
+lines = [f"{i}: {tokenizer.vocab[i]}" for i in range(256, 300)]
+sys.stdout.write("\n".join(lines) + "\n")